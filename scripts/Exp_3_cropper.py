@@ -1,11 +1,20 @@
 #!/usr/bin/env python3
-import utils
-import matplotlib.pyplot as plt
 import os
-from skimage import io
+from PIL import Image
 import re
-import numpy as np
 import argparse as arg
+import json
+import numpy as np
+import utils
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+
+FILE_PATTERN = re.compile(
+    r"uEye(?P<camera>[0-9]+) (?P<year>[0-9]+)-(?P<month>[0-9]+)-"
+    r"(?P<day>[0-9]+)--(?P<hour>[0-9]+)-.*"
+)
+OUT_FN_FORMAT = "{}_Tray{}_Pos{}_Camera{}_{}-{}-{}_{}h.jpg"
+CROP_SIZE = 1000
 
 
 def arg_reader():
@@ -23,6 +32,17 @@ def arg_reader():
                                         "pre_existing.")
     arg_parser.add_argument("coord_file", help="File containing the coordinates"
                                                "of each plant")
+    arg_parser.add_argument("-c", help="Cores used for multiprocessing, 1 by "
+                                       "default",
+                            type=int, default=1)
+    arg_parser.add_argument("-t", help="Threads per process used to write the "
+                                       "crops, so writing overlaps with "
+                                       "cropping. 1 by default",
+                            type=int, default=1)
+    arg_parser.add_argument("--pack", help="Write the crops of each day into "
+                                           "a single memory-mapped array "
+                                           "instead of separate jpg files.",
+                            action="store_true")
     return arg_parser.parse_args()
 
 
@@ -41,63 +61,163 @@ def parse_coords(infile):
     return out_dict
 
 
-def crop_worker(image_path, out_path, tray_dict):
-    pattern = re.compile(
-        r"uEye(?P<camera>[0-9]+) (?P<year>[0-9]+)-(?P<month>[0-9]+)-"
-        r"(?P<day>[0-9]+)--(?P<hour>[0-9]+)-.*"
+def crop_dir(out_path, match):
+    """ Gives the output directory of a tray image, one directory per day
+
+    :param out_path: str, the directory the crops are written to
+    :param match: re.Match, FILE_PATTERN matched on the tray image filename
+    :return: str, the directory for the crops of this tray image
+    """
+    return os.path.join(
+        out_path,
+        "-".join(
+            [match.group("day"),
+             match.group("month"),
+             match.group("year")]
+        )
     )
+
+
+def crop_names(match, plants):
+    """ Gives the filenames of the crops of a tray image
+
+    :param match: re.Match, FILE_PATTERN matched on the tray image filename
+    :param plants: list, dicts with the layout of each plant on the tray
+    :return: list, the filename of the crop of every plant
+    """
+    return [
+        OUT_FN_FORMAT.format(
+            plant["Accession"],
+            plant["Tray_num"],
+            plant["Plant_pos"],
+            match.group("camera"),
+            match.group("day"),
+            match.group("month"),
+            match.group("year"),
+            match.group("hour")
+        ) for plant in plants
+    ]
+
+
+def crop_file(arg_tup):
+    """ Crops all plants out of a single tray image
+
+    :param arg_tup: tuple, contains all parameters in order filename, out_path,
+        tray_dict, pack_start, threads. pack_start is the position of the first
+        crop in the crop pack of its day, or None to write jpg files. threads
+        is the amount of threads writing the crops.
+    :return: None, writes a crop for every plant on the tray
+    """
+    file, out_path, tray_dict, pack_start, threads = arg_tup
+    match = FILE_PATTERN.search(os.path.basename(file))
+    out_dir = crop_dir(out_path, match)
+    os.makedirs(out_dir, exist_ok=True)
+    plants = tray_dict[int(match.group("camera"))]
+    if pack_start is not None:
+        crops = np.load(os.path.join(out_dir, utils.CROP_PACK),
+                        mmap_mode="r+")
+    # Only the crops are converted, PIL fills parts outside the image with 0
+    image = Image.open(file)
+    image.load()
+    half = CROP_SIZE // 2
+
+    def write_crop(i, plant, name):
+        x = int(plant["x"])
+        y = int(plant["y"])
+        crop = image.crop((x - half, y - half, x + half, y + half))
+        # RGBA or palette crops can not be written as jpg
+        crop = crop.convert("RGB")
+        if pack_start is None:
+            crop.save(os.path.join(out_dir, name))
+        else:
+            crops[pack_start + i] = np.asarray(crop)
+
+    # PIL releases the GIL while encoding, so the writes run concurrently
+    with ThreadPoolExecutor(threads) as writers:
+        list(writers.map(write_crop, range(len(plants)), plants,
+                         crop_names(match, plants)))
+    if pack_start is not None:
+        crops.flush()
+
+
+def create_packs(files, out_path, tray_dict):
+    """ Allocates a crop pack for every day and writes its index
+
+    :param files: list, the tray image files that will be cropped
+    :param out_path: str, the directory the crops are written to
+    :param tray_dict: dict, the layout of the plants for every camera
+    :return: list, the position of the first crop of each file in the pack
+        of its day
+    """
+    indices = {}
+    sizes = {}
+    starts = []
+    for file in files:
+        match = FILE_PATTERN.search(os.path.basename(file))
+        out_dir = crop_dir(out_path, match)
+        index = indices.setdefault(out_dir, {})
+        start = sizes.get(out_dir, 0)
+        starts.append(start)
+        plants = tray_dict[int(match.group("camera"))]
+        # Crop names only carry the hour, so a name can occur in more than
+        # one tray image. Every file gets its own slots and the index points
+        # to the last one, like the jpg files that overwrite each other.
+        for i, name in enumerate(crop_names(match, plants)):
+            if name in index:
+                print(f"{name} occurs in more than one tray image, keeping "
+                      f"the crop of {os.path.basename(file)}")
+            index[name] = start + i
+        sizes[out_dir] = start + len(plants)
+    for out_dir, index in indices.items():
+        os.makedirs(out_dir, exist_ok=True)
+        np.lib.format.open_memmap(
+            os.path.join(out_dir, utils.CROP_PACK), mode="w+", dtype=np.uint8,
+            shape=(sizes[out_dir], CROP_SIZE, CROP_SIZE, 3)
+        ).flush()
+        with open(os.path.join(out_dir, utils.CROP_INDEX), "w") as index_file:
+            json.dump(index, index_file)
+    return starts
+
+
+def crop_worker(image_path, out_path, tray_dict, cores=1, pack=False,
+                threads=1):
     files = [os.path.join(image_path, file) for file in os.listdir(image_path)]
-    out_fn_format = "{}_Tray{}_Pos{}_Camera{}_{}-{}-{}_{}h.jpg"
 
     if not os.path.isdir(out_path):
         os.mkdir(out_path)
 
-    for file in files:
-        match = pattern.search(file)
-        out_dir = os.path.join(
-            out_path,
-            "-".join(
-                [match.group("day"),
-                 match.group("month"),
-                 match.group("year")]
-            )
-        )
-        if not os.path.isdir(out_dir):
-            os.mkdir(out_dir)
-        plants = tray_dict[int(match.group("camera"))]
-        image = io.imread(file)
-        pad = 500
-        image = np.pad(image, ((pad, pad), (pad, pad), (0, 0)), 'constant')
-        for plant in plants:
-            x = int(plant["x"]) + pad
-            y = int(plant["y"]) + pad
-            crop = utils.crop_region(
-                image=image,
-                centre=(x, y),
-                shape=(1000, 1000)
-            )
-            io.imsave(
-                os.path.join(
-                    out_dir,
-                    out_fn_format.format(
-                        plant["Accession"],
-                        plant["Tray_num"],
-                        plant["Plant_pos"],
-                        match.group("camera"),
-                        match.group("day"),
-                        match.group("month"),
-                        match.group("year"),
-                        match.group("hour")
-                    )),
-                crop
-            )
+    if pack:
+        starts = create_packs(files, out_path, tray_dict)
+    else:
+        starts = [None] * len(files)
+    params = [(file, out_path, tray_dict, start, threads)
+              for file, start in zip(files, starts)]
+    pool_handler(cores, crop_file, params)
+
+
+def pool_handler(cores, fun, params):
+    """ Multiprocessing pool handler
+
+    :param cores: int, amount of cores to be used
+    :param fun: function, the worker function
+    :param params: tuple, the parameter tuples
+    :return: None, maps arguments to function
+    """
+    if cores == 1:
+        for param in params:
+            fun(param)
+        return
+    with Pool(cores) as pools:
+        for _ in pools.imap_unordered(fun, params, chunksize=4):
+            pass
 
 
 def main():
     args = arg_reader()
 
     tray_dict = parse_coords(args.coord_file)
-    crop_worker(args.im_dir, args.out, tray_dict)
+    crop_worker(args.im_dir, args.out, tray_dict, args.c, args.pack,
+                args.t)
 
 
 if __name__ == "__main__":
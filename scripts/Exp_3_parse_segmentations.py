@@ -1,10 +1,21 @@
 #!/usr/bin/env python3
-from skimage import io, morphology
 import utils
+import numpy as np
 import os
 import re
 import matplotlib.pyplot as plt
 import argparse as arg
+import csv
+import json
+from multiprocessing import Pool
+
+FILENAME_PATTERN = re.compile(
+    r"(?P<Accession>LK[0-9]+)_Tray(?P<Tray>[0-9]+)_Pos(?P<Pos>[0-9]+)_"
+    r"Camera(?P<Camera>[0-9]+)_(?P<Date>[0-9]+-[0-9]+-[0-9]+)_"
+    r"(?P<Hour>[0-9]+).+"
+)
+MASK_CACHE = "mask_cache.npy"
+MASK_INDEX = "mask_cache.json"
 
 
 def arg_reader():
@@ -20,60 +31,222 @@ def arg_reader():
     arg_parser.add_argument("out", help="The directory to write the pixel table"
                                         "to. Does not need to be "
                                         "pre_existing.")
+    arg_parser.add_argument("-c", help="Cores used for multiprocessing, 1 by "
+                                       "default. Has no effect with --cache.",
+                            type=int, default=1)
+    arg_parser.add_argument("--cache", help="Read the masks from a memory-"
+                                            "mapped cache in the out "
+                                            "directory, which is built on the "
+                                            "first run and rebuilt when masks "
+                                            "were added, removed or changed.",
+                            action="store_true")
     return arg_parser.parse_args()
 
 
-def parse_segmentations(im_dir, out_dir):
+def mask_filename(file, out_dir):
+    """ Gives the filename of the mask belonging to an image
+
+    :param file: str, the filename of the image
+    :param out_dir: str, the directory containing the segmentation masks
+    :return: str, the path of the mask file
+    """
+    return os.path.join(
+        out_dir,
+        file.split("/")[-1].replace(".jpg", ".png")
+    )
+
+
+def count_mask(file, mask):
+    """ Counts the healthy and brown pixels in a mask
+
+    :param file: str, the filename of the image the mask belongs to
+    :param mask: np.ndarray, 2D mask with background as 0, healthy tissue as 1
+        and brown tissue as 2. None if there is no mask for the image.
+    :return: list, the fields parsed from the filename followed by the healthy
+        and brown pixel counts
+    """
+    match = FILENAME_PATTERN.match(os.path.basename(file))
+    if match:
+        exp_dat = list(match.groups())
+    else:
+        exp_dat = ["NA"] * 6
+    if mask is None:
+        exp_dat += ["NA", "NA"]
+    else:
+        counts = np.bincount(mask.ravel(), minlength=3)
+        exp_dat += [counts[1], counts[2]]
+    return exp_dat
+
+
+def parse_file(arg_tup):
+    """ Counts the healthy and brown pixels in the mask of a single image
+
+    :param arg_tup: tuple, contains all parameters in order file, out_dir
+    :return: list, the fields parsed from the filename followed by the healthy
+        and brown pixel counts
+    """
+    file, out_dir = arg_tup
+    mask_fn = mask_filename(file, out_dir)
+    mask = None
+    if os.path.isfile(mask_fn):
+        try:
+            mask = utils.read_mask(mask_fn)
+        except:
+            print(f"Could not read {mask_fn}")
+    return count_mask(file, mask)
+
+
+def mask_stats(image_files, out_dir):
+    """ Gives the modification time and size of the masks of a set of images
+
+    :param image_files: list, the filenames of the images
+    :param out_dir: str, the directory containing the segmentation masks
+    :return: dict, the image filenames as keys and a list with the
+        modification time in ns and size of their mask as values. Images
+        without a mask are left out.
+    """
+    stats = {}
+    for file in image_files:
+        try:
+            mask_stat = os.stat(mask_filename(file, out_dir))
+        except OSError:
+            continue
+        stats[file] = [mask_stat.st_mtime_ns, mask_stat.st_size]
+    return stats
+
+
+def build_mask_cache(im_dir, out_dir):
+    """ Stores all masks in a single memory-mapped array for repeated parsing
+
+    Masks that can not be read or differ in shape from the first mask are left
+    out of the cache, parse_segmentations reads those from disk. The
+    modification time and size of all masks are stored alongside the index,
+    so changed masks can be detected.
+
+    :param im_dir: str, the directory containing the RGB images matching
+        the segmentation masks in out_dir
+    :param out_dir: str, the directory containing the segmentation masks, the
+        cache is written here
+    :return: None, writes MASK_CACHE and MASK_INDEX to out_dir
+    """
+    stats = mask_stats(utils.list_images(im_dir), out_dir)
+    files = list(stats)
+    index = {}
+    masks = None
+    for file in files:
+        try:
+            mask = utils.read_mask(mask_filename(file, out_dir))
+        except:
+            continue
+        if masks is None:
+            masks = np.lib.format.open_memmap(
+                os.path.join(out_dir, MASK_CACHE), mode="w+", dtype=np.uint8,
+                shape=(len(files),) + mask.shape
+            )
+        if mask.shape == masks.shape[1:]:
+            masks[len(index)] = mask
+            index[file] = len(index)
+    if masks is not None:
+        masks.flush()
+    with open(os.path.join(out_dir, MASK_INDEX), "w") as index_file:
+        json.dump({"index": index, "stats": stats}, index_file)
+
+
+def load_mask_cache(image_files, out_dir):
+    """ Opens the mask cache written by build_mask_cache
+
+    :param image_files: list, the filenames of the images to parse
+    :param out_dir: str, the directory containing the cache
+    :return: tuple, the memory-mapped masks and a dict with the image
+        filenames as keys and their position in the masks as values. None if
+        there is no cache in out_dir, or if the masks of image_files on disk
+        do not match the ones in the cache.
+    """
+    cache_fn = os.path.join(out_dir, MASK_CACHE)
+    index_fn = os.path.join(out_dir, MASK_INDEX)
+    if not os.path.isfile(index_fn):
+        return None
+    with open(index_fn) as index_file:
+        cache_info = json.load(index_file)
+    if not isinstance(cache_info, dict) or "stats" not in cache_info:
+        print("Mask cache was written by an older version, rebuilding")
+        return None
+    stats = mask_stats(image_files, out_dir)
+    cached_stats = cache_info["stats"]
+    stale = sorted(file for file in set(stats) | set(cached_stats) if
+                   stats.get(file) != cached_stats.get(file))
+    if stale:
+        print(f"Masks changed since the cache was built, rebuilding: "
+              f"{', '.join(os.path.basename(file) for file in stale)}")
+        return None
+    index = cache_info["index"]
+    if not index:
+        return np.zeros((0, 0, 0), dtype=np.uint8), index
+    return np.load(cache_fn, mmap_mode="r"), index
+
+
+def _write_rows(writer, rows, total):
+    """ Writes the parsed rows to the pixel table, printing progress
+
+    :param writer: csv.writer, the writer of the pixel table
+    :param rows: iterable, the rows to write
+    :param total: int, the total amount of rows, used for printing progress
+    :return: None, writes the rows
+    """
+    for count, exp_dat in enumerate(rows, start=1):
+        writer.writerow(exp_dat)
+        if count % 100 == 0 or count == total:
+            print(f"File {count} of {total} parsed")
+
+
+def parse_segmentations(im_dir, out_dir, cores=1, cache=False):
     """ Function to parse segmentation images
 
     :param im_dir: str, the directory containing the RGB images matching
         the segmentation masks in out_dir
     :param out_dir: str, the directory to write the pixel table, also contains
         the segmentation masks as grayscale images
+    :param cores: int, amount of cores used to parse the masks
+    :param cache: bool, if True the masks are read from a memory-mapped cache
+        in out_dir, which is built first if it does not exist yet
     :return: None, writes a tab separated file
     """
-    filename_pattern = re.compile(
-        r"(?P<Accession>LK[0-9]+)_Tray(?P<Tray>[0-9]+)_Pos(?P<Pos>[0-9]+)_"
-        r"Camera(?P<Camera>[0-9]+)_(?P<Date>[0-9]+-[0-9]+-[0-9]+)_"
-        r"(?P<Hour>[0-9]+).+"
-    )
-    outfile = open(os.path.join(out_dir, "pixel_table.txt"), "w")
-    outfile.write("\t".join(
-        ["Accession", "Tray", "Pos", "Camera", "Date", "Hour", "Healhy",
-         "Brown"]) + "\n"
-    )
-    count = 0
-    image_files = os.listdir(im_dir)
-    for file in image_files:
-        match = filename_pattern.search(file)
-        if match:
-            exp_dat = list(match.groups())
-        else:
-            exp_dat = ["NA"] * 6
-        mask_fn = os.path.join(
-            out_dir,
-            file.split("/")[-1].replace(".jpg", ".png")
+    with open(os.path.join(out_dir, "pixel_table.txt"), "w", newline="",
+              buffering=1 << 20) as outfile:
+        writer = csv.writer(outfile, delimiter="\t", lineterminator="\n")
+        writer.writerow(
+            ["Accession", "Tray", "Pos", "Camera", "Date", "Hour", "Healhy",
+             "Brown"]
         )
-        try:
-            mask = io.imread(mask_fn, as_gray=True) // 0.5
-        except:
-            exp_dat += ["NA", "NA"]
+        image_files = utils.list_images(im_dir)
+        if cache:
+            cached = load_mask_cache(image_files, out_dir)
+            if cached is None:
+                build_mask_cache(im_dir, out_dir)
+                cached = load_mask_cache(image_files, out_dir)
+            masks, index = cached
+            # Masks left out of the cache are read from disk instead
+            rows = (count_mask(file, masks[index[file]]) if file in index else
+                    parse_file((file, out_dir)) for file in image_files)
+            _write_rows(writer, rows, len(image_files))
         else:
-            healthy = (mask == 1).sum()
-            brown = (mask == 2).sum()
-            exp_dat += [healthy, brown]
-        exp_dat = [str(dat) for dat in exp_dat]
-        outfile.write("\t".join(exp_dat) + "\n")
-        count += 1
-        print(f"File {count} of {len(image_files)} parsed")
-    outfile.close()
+            params = [(file, out_dir) for file in image_files]
+            if cores == 1:
+                rows = map(parse_file, params)
+                _write_rows(writer, rows, len(image_files))
+            else:
+                with Pool(cores) as pools:
+                    rows = pools.imap(parse_file, params, chunksize=32)
+                    _write_rows(writer, rows, len(image_files))
 
 
 def main():
     args = arg_reader()
     parse_segmentations(
         args.filename,
-        args.out
+        args.out,
+        args.c,
+        args.cache
     )
 
 
@@ -8,14 +8,19 @@ and for splitting the foreground into healthy and unhealthy tissue.
 import os
 import segment
 import utils
-from skimage import io, util, color, morphology, segmentation, filters
-from scipy import signal
+from skimage import io, util, morphology, segmentation, filters
 from multiprocessing import Pool
 import numpy as np
 import argparse as arg
-import matplotlib.pyplot as plt
+import csv
 import re
 
+FILENAME_PATTERN = re.compile(r"([0-9]+)-([0-9]+).+Tray_0([0-9]*)"
+                              r".+pos([0-9*])_(.*).png")
+DISK_2 = utils.read_only(morphology.disk(2))
+DISK_3_5 = utils.read_only(morphology.disk(3.5))
+DISK_5 = utils.read_only(morphology.disk(5))
+
 
 def shw_segmentation(image, distance=10, bg_mod=0.15, fg_mod=0.2):
     """ Creates binary image through sobel + histogram thresholds + watershed
@@ -27,28 +32,20 @@ def shw_segmentation(image, distance=10, bg_mod=0.15, fg_mod=0.2):
     :return np.ndarray, 2D mask for the image
     """
     if image.shape[2] == 4:
-        image = util.img_as_ubyte(color.rgba2rgb(image))
-    comp_sob = filters.sobel(image)
-    comp_sob = comp_sob[:, :, 0] + comp_sob[:, :, 1] + comp_sob[:, :, 2]
+        image = utils.rgba_to_rgb(image)
+    comp_sob = filters.sobel(util.img_as_float32(image)).sum(axis=2)
     elevation = filters.sobel(comp_sob)
-    values, bins = np.histogram(comp_sob, bins=100)
-    max_i, _ = signal.find_peaks(values, distance=distance)
-    max_bins = bins[max_i]
-    min_i, _ = signal.find_peaks(-values, distance=distance)
-    min_bins = bins[min_i]
-    min_bins = min_bins[min_bins > max_bins[0]]
-    markers = np.zeros_like(comp_sob)
-    markers[(comp_sob <= max_bins[0] + (bg_mod * (min_bins[0] - max_bins[0]))) |
-            (color.rgb2hsv(image)[:, :, 0] > 0.35) |
-            (color.rgb2hsv(image)[:, :, 2] > 0.95)
+    bg_thresh, fg_thresh = segment.histogram_thresholds(comp_sob, distance,
+                                                        bg_mod, fg_mod)
+    markers = np.zeros(comp_sob.shape, dtype=np.uint8)
+    markers[(comp_sob <= bg_thresh) |
+            (utils.rgb_hue(image) > 0.35) |
+            (util.img_as_float32(image.max(axis=2)) > 0.95)
     ] = 1
-    markers[(comp_sob >= min_bins[0] + (fg_mod * (max_bins[1] - min_bins[0]))) &
-            (color.rgb2hsv(image)[:, :, 0] <= 0.35) &
-            (color.rgb2hsv(image)[:, :, 2] <= 0.95)
-    ] = 2
-    markers[comp_sob >= min_bins[0] + (fg_mod * (max_bins[1] - min_bins[0]))] = 2
+    # Strong edges are foreground regardless of colour
+    markers[comp_sob >= fg_thresh] = 2
     mask = segmentation.watershed(elevation, markers)
-    mask = morphology.erosion(mask, footprint=morphology.disk(2))
+    mask = morphology.erosion(mask, footprint=DISK_2)
     return mask - 1
 
 
@@ -77,7 +74,14 @@ def arg_reader():
                                        "contains RGB images with the outline "
                                        "of the mask overlayed.",
                             action="store_true")
-    return arg_parser.parse_args()
+    arg_parser.add_argument("--diag_every", help="Only write diagnostic images "
+                                                 "for every nth file, 1 by "
+                                                 "default.",
+                            type=int, default=1)
+    args = arg_parser.parse_args()
+    if args.diag_every < 1:
+        arg_parser.error("--diag_every must be 1 or more")
+    return args
 
 
 def segment_file(arg_tup):
@@ -90,100 +94,119 @@ def segment_file(arg_tup):
     filename, outfile, sigma, diagnostic = arg_tup
     print(f"Starting bg_segmentation of {filename}")
     try:
-        rgb_im = io.imread(filename)
+        rgb_im = utils.read_image(filename)
         if rgb_im.shape[2] == 4:
-            rgb_im = util.img_as_ubyte(color.rgba2rgb(rgb_im))
+            rgb_im = utils.rgba_to_rgb(rgb_im)
     except:
         print(f"Could not open {filename}")
         return
     # Background masking
     bg_mask = shw_segmentation(rgb_im, distance=15, bg_mod=0.5,
                                fg_mod=0.5)
-    bg_mask = morphology.closing(bg_mask, footprint=morphology.disk(5))
+    bg_mask = morphology.closing(bg_mask.astype(bool), footprint=DISK_5)
     try:
         bg_mask = utils.canny_central_ob(rgb_im, bg_mask, sigma)
     except:
         print(f"Could not isolate primary object in {filename}")
         return
-    bg_mask = morphology.opening(bg_mask, footprint=morphology.disk(3.5))
+    bg_mask = morphology.opening(bg_mask, footprint=DISK_3_5)
     # Tipburn masking
     comp_mask = segment.barb_hue(rgb_im, bg_mask, 3.5)
-    plt.imsave(
-        fname=os.path.join(outfile,
-                           filename.split("/")[-1].replace(".jpg", ".png")),
-        arr=comp_mask.astype("uint8"),
-        cmap="binary_r",
-        vmin=0,
-        vmax=2
+    utils.write_mask(
+        os.path.join(outfile,
+                     filename.split("/")[-1].replace(".jpg", ".png")),
+        comp_mask
     )
     if diagnostic:
         diag_path = os.path.join(outfile, "diagnostic")
         if not os.path.isdir(diag_path):
             os.mkdir(diag_path)
-        plt.imsave(
+        io.imsave(
             os.path.join(
                 diag_path,
                 filename.split("/")[-1]
             ).replace(".jpg", "_bg.jpg"),
-            segmentation.mark_boundaries(rgb_im, bg_mask)
+            utils.mark_outline(rgb_im, bg_mask)
         )
-        plt.imsave(
+        io.imsave(
             os.path.join(
                 diag_path,
                 filename.split("/")[-1]
             ).replace(".jpg", "_tb.jpg"),
-            segmentation.mark_boundaries(rgb_im, comp_mask == 2)
+            utils.mark_outline(rgb_im, comp_mask == 2)
         )
 
 
-def parse_segmentations(image_files, out_dir):
+def parse_file(arg_tup):
+    """ Counts the healthy and brown pixels in the mask of a single image
+
+    :param arg_tup: tuple, contains all parameters in order file, out_dir
+    :return: list, the fields parsed from the filename followed by the healthy
+        and brown pixel counts of the full plant and of the hearth
+    """
+    file, out_dir = arg_tup
+    match = FILENAME_PATTERN.match(os.path.basename(file))
+    if match:
+        exp_dat = list(match.groups())
+    else:
+        exp_dat = ["NA"] * 5
+    mask_fn = out_dir + "/" + file.split("/")[-1]
+    mask_fn = mask_fn.replace(".png", "_comp.png")
+    mask = None
+    if os.path.isfile(mask_fn):
+        try:
+            mask = utils.read_mask(mask_fn)
+        except:
+            print(f"Could not read {mask_fn}")
+    if mask is None:
+        exp_dat += ["NA", "NA", "NA", "NA"]
+    else:
+        full_counts = utils.disk_counts(mask, (min(mask.shape) - 1) / 2)
+        hearth_counts = utils.disk_counts(mask, (min(mask.shape) - 2) / 4)
+        exp_dat += [full_counts[1], full_counts[2], hearth_counts[1],
+                    hearth_counts[2]]
+    return exp_dat
+
+
+def _write_rows(writer, rows, total):
+    """ Writes the parsed rows to the pixel table, printing progress
+
+    :param writer: csv.writer, the writer of the pixel table
+    :param rows: iterable, the rows to write
+    :param total: int, the total amount of rows, used for printing progress
+    :return: None, writes the rows
+    """
+    for count, exp_dat in enumerate(rows, start=1):
+        writer.writerow(exp_dat)
+        if count % 100 == 0 or count == total:
+            print(f"File {count} of {total} parsed")
+
+
+def parse_segmentations(image_files, out_dir, cores=1):
     """ Function to parse segmentation images
 
     :param image_files: str, the directory containing the RGB images matching
         the segmentation masks in out_dir
     :param out_dir: str, the directory to write the pixel table, also contains
         the segmentation masks as grayscale images
+    :param cores: int, amount of cores used to parse the masks
     :return: None, writes a tab separated file
     """
-    filename_pattern = re.compile(r".*[\/\\]([0-9]+)-([0-9]+).+Tray_0([0-9]*)"
-                                  r".+pos([0-9*])_(.*).png")
-    outfile = open(out_dir + "/pixel_table.txt", "w")
-    outfile.write("\t".join(
-        ["experiment", "round", "tray", "position", "accession", "full_healthy",
-         "full_brown", "hearth_healthy", "hearth_brown"]) + "\n"
-    )
-    count = 0
-    for file in image_files:
-        match = filename_pattern.search(file)
-        if match:
-            exp_dat = list(match.groups())
-        else:
-            exp_dat = ["NA"] * 5
-        mask_fn = out_dir + "/" + file.split("/")[-1]
-        mask_fn = mask_fn.replace(".png", "_comp.png")
-        try:
-            mask = io.imread(mask_fn, as_gray=True) // 0.5
-        except:
-            exp_dat += ["NA", "NA", "NA", "NA"]
+    with open(out_dir + "/pixel_table.txt", "w", newline="",
+              buffering=1 << 20) as outfile:
+        writer = csv.writer(outfile, delimiter="\t", lineterminator="\n")
+        writer.writerow(
+            ["experiment", "round", "tray", "position", "accession",
+             "full_healthy", "full_brown", "hearth_healthy", "hearth_brown"]
+        )
+        params = [(file, out_dir) for file in image_files]
+        if cores == 1:
+            rows = map(parse_file, params)
+            _write_rows(writer, rows, len(image_files))
         else:
-            full_mask = morphology.disk((min(mask.shape[:2]) - 1)/2) * mask
-            healthy_full = (full_mask == 1).sum()
-            brown_full = (full_mask == 2).sum()
-            hearth_disk = morphology.disk((min(mask.shape[:2]) - 2)/4)
-            hearth = utils.crop_region(
-                mask,
-                (mask.shape[0] // 2, mask.shape[1] // 2),
-                (hearth_disk.shape[0], hearth_disk.shape[1])
-            )
-            hearth_mask = hearth * hearth_disk
-            healthy_hearth = (hearth_mask == 1).sum()
-            brown_hearth = (hearth_mask == 2).sum()
-            exp_dat += [healthy_full, brown_full, healthy_hearth, brown_hearth]
-        exp_dat = [str(dat) for dat in exp_dat]
-        outfile.write("\t".join(exp_dat) + "\n")
-        count += 1
-        print(f"File {count} of {len(image_files)} parsed")
-    outfile.close()
+            with Pool(cores) as pools:
+                rows = pools.imap(parse_file, params, chunksize=32)
+                _write_rows(writer, rows, len(image_files))
 
 
 def worker_wrapper(params):
@@ -206,8 +229,14 @@ def pool_handler(cores, fun, params):
     :param params: tuple, the parameter tuples
     :return: None, maps arguments to function
     """
-    pools = Pool(cores)
-    pools.map(fun, params)
+    if cores == 1:
+        for param in params:
+            fun(param)
+        return
+    # Every file takes seconds, so they are handed out one at a time
+    with Pool(cores) as pools:
+        for _ in pools.imap_unordered(fun, params):
+            pass
 
 
 def main():
@@ -218,11 +247,12 @@ def main():
     if not os.path.isdir(args.out):
         os.mkdir(args.out)
     # Create list of files
-    files = [args.filename + "/" + file for file in os.listdir(args.filename)]
+    files = [args.filename + "/" + file for file in
+             utils.list_images(args.filename)]
     param_list = zip(
         files, [args.out] * len(files),
         [args.s] * len(files),
-        [args.d] * len(files))
+        [args.d and i % args.diag_every == 0 for i in range(len(files))])
     # Pooled segmentation
     pool_handler(args.c, worker_wrapper, param_list)
 
@@ -5,13 +5,14 @@ Author: Chris Dijkstra
 Script for segmentation of unhealthy from healthy tissue in RGB colorspace.
 """
 
-from skimage import io, color, morphology, util
-import matplotlib.pyplot as plt
+from skimage import io, morphology
 import segment
 import utils
 import numpy as np
 import argparse as arg
 import os
+import csv
+from multiprocessing import Pool
 
 
 def arg_reader():
@@ -31,32 +32,12 @@ def arg_reader():
                                        "Used to remove high contrast bordering"
                                        "objects.",
                             type=float, default=3.0)
+    arg_parser.add_argument("-c", help="Cores used for multiprocessing, 1 by "
+                                       "default",
+                            type=int, default=1)
     return arg_parser.parse_args()
 
 
-def barb_thresh(im_channel):
-    """ Defines the threshold of an image channel based on its histogram
-
-      :param im_channel: np.ndarray, 2d array, meant to be hue channel of hsv or
-          a channel of lab
-      :return float, the threshold of the image channel that separates it into
-          healthy and unhealthy tissue
-    """
-    values, bins = np.histogram(im_channel, bins=100)
-    peak_i = np.argmax(values)
-    val_max = values[peak_i]
-    bin_max = bins[peak_i]
-    if bin_max <= 0.4:
-        bound = 0.2 * val_max
-    else:
-        bound = 0.5 * val_max
-    ref_val = values[values > bound][-1]
-    ref_i = np.where(values == ref_val)[0][0]
-    ref_bin = bins[ref_i]
-    thresh = 2 * ref_bin / 3
-    return thresh
-
-
 def barb_hue(image, bg_mask=None):
     """ Takes an image of plant tissue and segments into healthy and brown
 
@@ -69,90 +50,103 @@ def barb_hue(image, bg_mask=None):
         # Apply mask to rgb_im
         image = utils.multichannel_mask(image, bg_mask)
     # Get hue channel and scale from 0 to 1
-    hue = color.rgb2hsv(image)[:, :, 0]
+    hue = utils.rgb_hue(image)
     hue_con = utils.increase_contrast(hue)
     hue_fg = hue_con[bg_mask == 1]
     # Healthy tissue masking
-    thresh = barb_thresh(hue_fg)
-    healthy_mask = (hue_con > thresh).astype(int)
+    thresh = segment.barb_thresh(hue_fg)
+    healthy_mask = hue_con > thresh
     # Combine healthy and bg mask to get compound image
-    bg_mask = bg_mask.astype(int)
+    bg_mask = bg_mask.astype(np.uint8)
     comp_mask = segment.merge_masks(bg_mask, healthy_mask)
     return comp_mask
 
 
+def process_file(arg_tup):
+    """ Segments a single image into background, healthy and brown tissue
+
+    :param arg_tup: tuple, contains all parameters in order directory, file,
+        out, sigma
+    :return: list, the fields of the pixel table row for the image, all "NA"
+        if segmentation failed. None if the image could not be opened.
+    """
+    directory, file, out, sigma = arg_tup
+    try:
+        rgb_im = io.imread(directory + "/" + file)
+        if rgb_im.shape[2] == 4:
+            rgb_im = utils.rgba_to_rgb(rgb_im)
+    except:
+        print(f"Could not open {directory + '/' + file}")
+        return None
+    # Create bg_mask
+    try:
+        bg_mask = segment.shw_segmentation(rgb_im)
+    except:
+        print(f"Could not segment foreground from background in "
+              f"{directory + '/' + file}")
+        return ["NA"] * 7
+    # Only keep centre object
+    try:
+        bg_mask = utils.canny_central_ob(rgb_im, bg_mask, sigma)
+    except:
+        print(f"Could not find the central object in "
+              f"{directory + '/' + file}")
+        return ["NA"] * 7
+    # Remove lines
+    bg_mask = morphology.opening(bg_mask, footprint=utils.RECT_5_10)
+    bg_mask = morphology.opening(bg_mask, footprint=utils.RECT_10_5)
+    # Create compound array
+    try:
+        comp_im = barb_hue(rgb_im, bg_mask)
+    except:
+        print(f"Could not segment healthy from brown in"
+              f"{directory + '/' + file}")
+        return ["NA"] * 7
+    # Write image
+    bg = utils.multichannel_mask(rgb_im, comp_im == 0)
+    # Every pixel is either in bg or in fg, so no second mask is needed
+    fg = rgb_im - bg
+    tb = utils.multichannel_mask(rgb_im, comp_im == 2)
+    io.imsave(out + "/" + file.replace(".png", "_bg.png"), bg,
+              check_contrast=False)
+    io.imsave(out + "/" + file.replace(".png", "_fg.png"), fg,
+              check_contrast=False)
+    io.imsave(out + "/" + file.replace(".png", "_tb.png"), tb,
+              check_contrast=False)
+    # Table row
+    file_split = file.split("-")
+    experiment = file_split[0]
+    ex_round = file_split[1]
+    tray = file_split[2].split("_")[-1]
+    pos = file_split[4].split("_")[1]
+    accession = file_split[4].split("_")[2].replace(".png", "")
+    counts = np.bincount(comp_im.ravel(), minlength=3)
+    return [experiment, ex_round, tray, pos, accession, counts[1], counts[2]]
+
+
 def main():
     """ The main function """
     args = arg_reader()
     directory = args.filename
     if not os.path.isdir(args.out):
         os.mkdir(args.out)
-    out_table = open(args.out + "/pixel_table.txt", "w")
-    header = "\t".join([
-        "Experiment", "Round", "Tray", "Position", "Accession", "Healthy",
-        "Brown\n"
-    ])
-    out_table.write(header)
-    if os.path.isdir(directory):
-        files = os.listdir(directory)
-        for file in files:
-            try:
-                rgb_im = io.imread(directory + "/" + file)
-                if rgb_im.shape[2] == 4:
-                    rgb_im = util.img_as_ubyte(color.rgba2rgb(rgb_im))
-            except:
-                print(f"Could not open {directory + '/' + file}")
+    with open(args.out + "/pixel_table.txt", "w", newline="",
+              buffering=1 << 20) as out_table:
+        writer = csv.writer(out_table, delimiter="\t", lineterminator="\n")
+        writer.writerow(
+            ["Experiment", "Round", "Tray", "Position", "Accession", "Healthy",
+             "Brown"]
+        )
+        if os.path.isdir(directory):
+            files = os.listdir(directory)
+            params = [(directory, file, args.out, args.s) for file in files]
+            if args.c == 1:
+                rows = map(process_file, params)
+                writer.writerows(row for row in rows if row is not None)
             else:
-                # Create bg_mask
-                try:
-                    bg_mask = segment.shw_segmentation(rgb_im)
-                except:
-                    print(f"Could not segment foreground from background in "
-                          f"{directory + '/' + file}")
-                    out_table.write("\t".join(["NA"] * 7) + "\n")
-                else:
-                    # Only keep centre object
-                    bg_mask = utils.canny_central_ob(rgb_im, bg_mask, args.s)
-                    # Remove lines
-                    bg_mask = morphology.opening(bg_mask,
-                                                 footprint=np.ones((5, 10)))
-                    bg_mask = morphology.opening(bg_mask,
-                                                 footprint=np.ones((10, 5)))
-                    # Create compound array
-                    try:
-                        comp_im = barb_hue(rgb_im, bg_mask)
-                    except:
-                        print(f"Could not segment healthy from brown in"
-                              f"{directory + '/' + file}")
-                        out_table.write("\t".join(["NA"] * 7) + "\n")
-                    else:
-                        # Write image
-                        bg = utils.multichannel_mask(rgb_im, comp_im == 0)
-                        fg = utils.multichannel_mask(rgb_im, comp_im > 0)
-                        tb = utils.multichannel_mask(rgb_im, comp_im == 2)
-                        plt.imsave(
-                            args.out + "/" + file.replace(".png", "_bg.png"),
-                            arr=bg)
-                        plt.imsave(
-                            args.out + "/" + file.replace(".png", "_fg.png"),
-                            arr=fg)
-                        plt.imsave(
-                            args.out + "/" + file.replace(".png", "_tb.png"),
-                            arr=tb)
-                        # Write table
-                        file_split = file.split("-")
-                        experiment = file_split[0]
-                        ex_round = file_split[1]
-                        tray = file_split[2].split("_")[-1]
-                        pos = file_split[4].split("_")[1]
-                        accession = file_split[4].split("_")[2].replace(".png",
-                                                                        "")
-                        healthy = str((comp_im == 1).sum())
-                        brown = str((comp_im == 2).sum()) + "\n"
-                        out_table.write(
-                            "\t".join([experiment, ex_round, tray, pos,
-                                       accession, healthy, brown]))
-    out_table.close()
+                with Pool(args.c) as pools:
+                    rows = pools.imap(process_file, params)
+                    writer.writerows(row for row in rows if row is not None)
 
 
 if __name__ == "__main__":
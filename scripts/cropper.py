@@ -5,13 +5,25 @@ Author: Chris Dijkstra
 Script for segmentation of RGB images based on a tray registration file.
 """
 
-from skimage import io, color
+from skimage import io
 import utils
-import matplotlib.pyplot as plt
 import argparse as arg
 import os
 import re
 
+TRAY_PATTERN = re.compile(r"Tray_0(\d+)")
+COORD_DICT = {
+    1: (1330, 810),
+    2: (2059, 810),
+    3: (2790, 810),
+    4: (1330, 1530),
+    5: (2059, 1530),
+    6: (2790, 1530),
+    7: (1330, 2260),
+    8: (2059, 2260),
+    9: (2790, 2260)
+}
+
 
 def arg_reader():
     """ Reads arguments from command line
@@ -39,27 +51,14 @@ def crop_images(image, poslist, shape):
 
     :param image: np.ndarray, the full image that needs to be cropped.
     :param poslist: list of ints, the positions that need to be cropped out of
-        the main image, gets matched with internal coord_dict.
+        the main image, gets matched with COORD_DICT.
     :param shape: tuple of ints, the height and width of the output crops in
         pixels
     :return: list of np.ndarrays, the crops from the main image.
     """
-    poslist.sort()
-    coord_dict = {
-        1: (1330, 810),
-        2: (2059, 810),
-        3: (2790, 810),
-        4: (1330, 1530),
-        5: (2059, 1530),
-        6: (2790, 1530),
-        7: (1330, 2260),
-        8: (2059, 2260),
-        9: (2790, 2260)
-    }
-    croplist = []
-    for pos in poslist:
-        croplist.append(utils.crop_region(image, coord_dict[pos], shape))
-    return croplist
+    # The crops are views into image, nothing is copied until they are saved
+    return [utils.crop_region(image, COORD_DICT[pos], shape)
+            for pos in sorted(poslist)]
 
 
 def _parse_trayfile(filename):
@@ -72,14 +71,13 @@ def _parse_trayfile(filename):
     acc_dict = {}
     with open(filename) as infile:
         for line in infile:
-            line = line.strip().split(";")
-            tray_num = int(line[0].split("_")[-1])
+            line = line.strip()
+            if not line:
+                continue
+            line = line.split(";")
+            tray_num = int(line[0].rsplit("_", 1)[-1])
             pos = line[2].split()[-1]
-            acc = line[4]
-            if tray_num not in acc_dict:
-                acc_dict[tray_num] = [(pos, acc)]
-            else:
-                acc_dict[tray_num].append((pos, acc))
+            acc_dict.setdefault(tray_num, []).append((pos, line[4]))
     return acc_dict
 
 
@@ -87,7 +85,6 @@ def main():
     """ The main function """
     args = arg_reader()
     acc_inf = _parse_trayfile(args.trayfile)
-    tray_pattern = re.compile(r"Tray_0(\d+)")
     filecount = 0
     if not os.path.isdir(args.out):
         os.mkdir(args.out)
@@ -103,8 +100,8 @@ def main():
                 print(f"Could not open {args.filename + '/' + file}")
             else:
                 if image.shape[2] == 4:
-                    image = color.rgba2rgb(image)
-                match = tray_pattern.search(file)
+                    image = utils.rgba_to_rgb(image)
+                match = TRAY_PATTERN.search(file)
                 tray_num = int(match.group(1))
                 accs = acc_inf[tray_num]
                 if len(accs) == 5:
@@ -116,7 +113,7 @@ def main():
                     pos, acc = acc_dat
                     out_fn = args.out + "/" + file.replace(
                         ".png", f"_pos{pos}_{acc}.png")
-                    plt.imsave(fname=out_fn, arr=crop)
+                    io.imsave(out_fn, crop, check_contrast=False)
             if args.vocal:
                 filecount += 1
                 print(f"File {filecount} of {tot_files}")
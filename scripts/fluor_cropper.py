@@ -9,9 +9,13 @@ import utils
 import argparse as arg
 import os
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import segment
-import matplotlib.pyplot as plt
+from matplotlib import colormaps
 import numpy as np
+from scipy import fft
+
+VIRIDIS = colormaps["viridis"]
 
 
 def arg_reader():
@@ -39,41 +43,80 @@ def arg_reader():
                                        "fluorescence crops of the mask "
                                        "overlayed.",
                             action="store_true")
+    arg_parser.add_argument("--threads", help="Use threads instead of "
+                                              "processes for the -c workers. "
+                                              "Uses less memory, as the "
+                                              "workers share one interpreter.",
+                            action="store_true")
     return arg_parser.parse_args()
 
 
 def rough_crop(mask_a, mask_b, step):
     """ Takes stepwise crops of mask b to get best match with mask a
 
+    The overlap of all crops is computed at once, by cross-correlating the
+    masks in the frequency domain and counting the foreground of mask_b in
+    each crop with a summed area table.
+
     :param mask_a: np.ndarray, binary mask to be matched with b
     :param mask_b: np.ndarray, larger binary mask, mask a should fit within
     :param step: int, the step size used to move mask a over mask b
     :return: tuple, the centre of the crop where mask_a had the greatest
         similarity with mask_b
     """
-    rough_overlap_dict = {}
-    min_r = mask_a.shape[0] // 2
-    max_r = mask_b.shape[0] - mask_a.shape[0] // 2
-    min_c = mask_a.shape[1] // 2
-    max_c = mask_b.shape[1] - mask_a.shape[1] // 2
-    for row in range(min_r, max_r + 1, step):
-        for col in range(min_c, max_c + 1, step):
-            crop = utils.crop_region(mask_b, (col, row), mask_a.shape)
-            overlap = (crop == mask_a).sum()
-            rough_overlap_dict[overlap] = (col, row)
-    optimum = rough_overlap_dict[max(rough_overlap_dict.keys())]
-    return optimum
-
-
-def overlap_crop(rgb_im, full_image):
+    height, width = mask_a.shape
+    rows = np.arange(0, mask_b.shape[0] - height + 1, step)
+    cols = np.arange(0, mask_b.shape[1] - width + 1, step)
+    # Foreground pixels shared by mask_a and each crop, as the crops do not
+    # cross the border of mask_b the circular correlation does not wrap
+    fft_shape = [fft.next_fast_len(size, real=True) for size in mask_b.shape]
+    shared = fft.irfft2(
+        fft.rfft2(mask_b, fft_shape) * fft.rfft2(mask_a, fft_shape).conj(),
+        fft_shape
+    )
+    shared = np.rint(shared[np.ix_(rows, cols)]).astype(np.int64)
+    # Foreground pixels of mask_b in each crop
+    table = np.zeros((mask_b.shape[0] + 1, mask_b.shape[1] + 1), dtype=np.int64)
+    table[1:, 1:] = mask_b.cumsum(axis=0).cumsum(axis=1)
+    in_crop = (table[np.ix_(rows + height, cols + width)]
+               - table[np.ix_(rows, cols + width)]
+               - table[np.ix_(rows + height, cols)]
+               + table[np.ix_(rows, cols)])
+    # Pixels that are foreground in both or background in both
+    overlap = 2 * shared - in_crop - np.count_nonzero(mask_a) + height * width
+    # As in a row by row scan, the last crop with the highest overlap wins
+    best = np.flatnonzero(overlap == overlap.max())[-1]
+    row, col = np.unravel_index(best, overlap.shape)
+    return int(cols[col] + width // 2), int(rows[row] + height // 2)
+
+
+def false_color(image):
+    """ Maps a grayscale image onto the viridis colormap, like plt.imsave
+
+    :param image: np.ndarray, 2d array representing grayscale image
+    :return: np.ndarray, 3d uint8 array representing an RGB image, the minimum
+        of image is dark blue and the maximum is yellow
+    """
+    low, high = image.min(), image.max()
+    if high > low:
+        scaled = (image - low) / (high - low)
+    else:
+        scaled = np.zeros_like(image)
+    return VIRIDIS(scaled, bytes=True)[:, :, :3]
+
+
+def overlap_crop(rgb_im, full_image, mask_b=None):
     """ Uses initial rough crop with phase cross correlation to get match crops
 
     :param rgb_im: np.ndarray, 3d array representing an RGB image
     :param full_image: np.ndarray, 2d array representing grayscale image
+    :param mask_b: np.ndarray, 2d binary mask of full_image. If None it is
+        made with an Otsu threshold, pass it when full_image is reused.
     :return: tuple, the centre of the phase cross correlated rough crop
     """
     mask_a = segment.shw_segmentation(rgb_im)
-    mask_b = full_image > filters.threshold_otsu(full_image)
+    if mask_b is None:
+        mask_b = full_image > filters.threshold_otsu(full_image)
     rough_cen = rough_crop(mask_a, mask_b, 50)
     crop = utils.crop_region(full_image, rough_cen, (1500, 1500))
     crop_mask = crop > filters.threshold_otsu(crop)
@@ -102,39 +145,47 @@ def worker(arg_tup):
             print(f"could not read fluorescence images, "
                   f"Exception: {e}",
                   flush=True)
+            return
+        # The same mask is matched against every rgb crop
+        fm_mask = fm_im > filters.threshold_otsu(fm_im)
         for rgb in rgbs:
             rgb_im = io.imread(rgb)
             rgb_fn = rgb.split("/")[-1]
             try:
-                new_centre = overlap_crop(rgb_im, fm_im)
+                new_centre = overlap_crop(rgb_im, fm_im, fm_mask)
             except Exception as e:
                 print(f"Could not overlap {rgb_fn} with {fm}, "
                       f"Exception : {e}",
                       flush=True)
-            fm_crop = utils.crop_region(np.pad(fm_im, 500),
-                                        (new_centre[0] + 500,
-                                         new_centre[1] + 500),
-                                        (1500, 1500))
+                continue
+            fm_crop = utils.crop_region_padded(fm_im, new_centre, (1500, 1500))
             np.save(cmd_args.out + "/" + rgb_fn.replace(".png", "_Fm"),
                     fm_crop)
             if cmd_args.d:
                 if not os.path.isdir(cmd_args.out + "/diagnostic"):
                     os.mkdir(cmd_args.out + "/diagnostic")
-                plt.imsave(cmd_args.out + "/diagnostic/" + rgb_fn.replace(
+                io.imsave(cmd_args.out + "/diagnostic/" + rgb_fn.replace(
                     ".png", "_Fm.png"),
-                           fm_crop)
+                          false_color(fm_crop), check_contrast=False)
 
 
-def pool_handler(cores, fun, params):
+def pool_handler(cores, fun, params, threads=False):
     """ Multiprocessing pool handler
 
     :param cores: int, amount of cores to be used
     :param fun: function, the worker function
     :param params: tuple, the parameter tuples
+    :param threads: bool, if True the workers are threads instead of processes
     :return: None, maps arguments to function
     """
-    pools = Pool(cores)
-    pools.map(fun, params)
+    if cores == 1:
+        for param in params:
+            fun(param)
+        return
+    pool_class = ThreadPool if threads else Pool
+    with pool_class(cores) as pools:
+        for _ in pools.imap_unordered(fun, params):
+            pass
 
 
 def main():
@@ -149,16 +200,21 @@ def main():
                    os.listdir(args.fluor_path) if file.endswith("-Fm.fimg")]
     rgb_files = [args.rgb_path + "/" + file for file in
                  os.listdir(args.rgb_path)]
-    # Match dict
+    # Match dict, rgb files are grouped by identifier in a single pass
+    rgb_dict = {}
+    for file in rgb_files:
+        fields = file.split("/")[-1].split("-")
+        if len(fields) > 3:
+            rgb_dict.setdefault("-".join(fields[0:3]), []).append(file)
     match_dict = {}
     for file in fluor_files:
-        ident = "-".join(file.split("/")[-1].split("-")[0:3]) + "-"
-        match_dict[file] = [file for file in rgb_files if
-                            file.split("/")[-1].startswith(ident)]
+        ident = "-".join(file.split("/")[-1].split("-")[0:3])
+        match_dict[file] = rgb_dict.get(ident, [])
     params = [tuple(list(tup) + [args]) for tup in match_dict.items()]
     pool_handler(args.c,
                  worker,
-                 params)
+                 params,
+                 args.threads)
 
 
 if __name__ == "__main__":
@@ -8,11 +8,15 @@ masks of RGB and chlorophyll fluorescence.
 import os
 import segment
 import utils
-from skimage import io, util, color, morphology, filters
+from skimage import io, morphology, filters
 from multiprocessing import Pool
+from itertools import repeat
 import numpy as np
 import argparse as arg
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+
+DISK_2 = utils.read_only(morphology.disk(2))
+DISK_2_5 = utils.read_only(morphology.disk(2.5))
 
 
 def arg_reader():
@@ -53,19 +57,7 @@ def fluor_thresh(im_channel):
       :return float, the threshold of the image channel that separates it into
           healthy and unhealthy tissue
     """
-    values, bins = np.histogram(im_channel, bins=100)
-    peak_i = np.argmax(values)
-    val_max = values[peak_i]
-    bin_max = bins[peak_i]
-    if bin_max <= 0.4:
-        bound = 0.2 * val_max
-    else:
-        bound = 0.5 * val_max
-    ref_val = values[values > bound][-1]
-    ref_i = np.where(values == ref_val)[0][0]
-    ref_bin = bins[ref_i]
-    thresh = 2 * ref_bin / 4.5
-    return thresh
+    return segment.barb_thresh(im_channel, 4.5)
 
 
 def pool_handler(cores, fun, params):
@@ -76,33 +68,84 @@ def pool_handler(cores, fun, params):
     :param params: tuple, the parameter tuples
     :return: None, maps arguments to function
     """
-    pools = Pool(cores)
-    pools.map(fun, params)
+    if cores == 1:
+        for param in params:
+            fun(param)
+        return
+    # A crop takes seconds to segment, so chunking would not pay off
+    with Pool(cores) as pools:
+        for _ in pools.imap_unordered(fun, params):
+            pass
+
+
+def match_fluor(rgb_files, fluor_dir):
+    """ Finds the Fm crop belonging to each RGB crop
+
+    :param rgb_files: list, paths of the RGB crops
+    :param fluor_dir: str, the directory holding the fluorescence crops
+    :return: list, the path of the matching Fm crop for every RGB crop, None
+        where no match was found
+    """
+    fluor_index = {}
+    for file in os.listdir(fluor_dir):
+        fields = file.split("-")
+        if len(fields) > 3 and file.endswith("_Fm.npy"):
+            fluor_index.setdefault("-".join(fields[:3]), []).append(file)
+    matches = []
+    for rgb_crop in rgb_files:
+        rgb_fn = rgb_crop.split("/")[-1]
+        ident = "-".join(rgb_fn.split("-")[:3])
+        pos = rgb_fn.split("_")[-2]
+        match = [file for file in fluor_index.get(ident, []) if
+                 file.find(pos) != -1]
+        matches.append(fluor_dir + "/" + match[0] if match else None)
+    return matches
+
+
+_DIAG_PLOTS = {}
+
+
+def diagnostic_plot(shape):
+    """ Returns the 2x2 diagnostic figure for crops of a certain shape
+
+    The figure is made once per process and shape, after that only the data
+    of its images has to be replaced.
+
+    :param shape: tuple, the rows and columns of the crops
+    :return: tuple, the figure and its four images, in order the RGB crop,
+        the fluorescence and background overlay, the RGB mask and the final
+        mask
+    """
+    if shape not in _DIAG_PLOTS:
+        plot = Figure(figsize=(20, 20))
+        axes = plot.subplots(2, 2, sharex=True, sharey=True)
+        blank = np.zeros(shape, dtype=np.uint8)
+        images = [axes[0, 0].imshow(np.zeros(shape + (3,), dtype=np.uint8)),
+                  axes[0, 1].imshow(blank, cmap="viridis_r"),
+                  axes[1, 0].imshow(blank),
+                  axes[1, 1].imshow(blank)]
+        plot.tight_layout()
+        _DIAG_PLOTS[shape] = plot, images
+    return _DIAG_PLOTS[shape]
 
 
 def worker(arg_tup):
     """ Worker for multiprocessing
 
-    :param arg_tup: tuple, contains arguments
+    :param arg_tup: tuple, contains all parameters in order rgb_crop,
+        fluor_match, outdir, diag, sigma. fluor_match is the path of the
+        matching Fm crop, or None if there is none.
     :return: None, writes outfiles
     """
-    rgb_crop, fluor_dir, outdir, diag, sigma = arg_tup
+    rgb_crop, fluor_match, outdir, diag, sigma = arg_tup
     rgb_fn = rgb_crop.split("/")[-1]
-    ident = "-".join(rgb_fn.split("-")[:3])
-    pos = rgb_fn.split("_")[-2]
-    fluor_files = os.listdir(fluor_dir)
-    try:
-        fluor_match = [file for file in fluor_files if
-                       file.startswith(ident + "-") and file.find(pos) != -1
-                       and file.endswith("_Fm.npy")][0]
-    except Exception as e:
-        print(f"Could not find a fluor match for {rgb_fn}. Exception: {e}",
-              flush=True)
+    if fluor_match is None:
+        print(f"Could not find a fluor match for {rgb_fn}.", flush=True)
         return
     # Handle RGB
     rgb_im = io.imread(rgb_crop)
     if rgb_im.shape[2] == 4:
-        rgb_im = util.img_as_ubyte(color.rgba2rgb(rgb_im))
+        rgb_im = utils.rgba_to_rgb(rgb_im)
     try:
         bg_mask = segment.shw_segmentation(rgb_im)
     except Exception as e:
@@ -110,55 +153,46 @@ def worker(arg_tup):
               flush=True)
         return
     bg_mask = utils.canny_central_ob(rgb_im, bg_mask, sigma)
-    bg_mask = morphology.opening(bg_mask, footprint=np.ones((5, 10)))
-    bg_mask = morphology.opening(bg_mask, footprint=np.ones((10, 5)))
+    bg_mask = morphology.opening(bg_mask, footprint=utils.RECT_5_10)
+    bg_mask = morphology.opening(bg_mask, footprint=utils.RECT_10_5)
     bg_mask = morphology.remove_small_holes(
         bg_mask,
         area_threshold=bg_mask.shape[0] * bg_mask.shape[1] // 1000
     )
     tb_mask = segment.barb_hue(
         rgb_im,
-        morphology.erosion(bg_mask.copy(), footprint=morphology.disk(2))
+        morphology.erosion(bg_mask, footprint=DISK_2)
     )
-    comp_mask = bg_mask.astype(int)
+    comp_mask = bg_mask.astype(np.uint8)
     comp_mask[
         morphology.remove_small_objects(
             morphology.opening(
                 tb_mask == 2,
-                footprint=morphology.disk(2)))] = 2
+                footprint=DISK_2))] = 2
 
     # Handle fluor
-    fvfm_im = np.load(fluor_dir + "/" + fluor_match)
-    fvfm_im = filters.median(fvfm_im, footprint=morphology.disk(2.5))
+    fvfm_im = np.load(fluor_match)
+    fvfm_im = filters.median(fvfm_im, footprint=DISK_2_5)
     fvfm_im = utils.increase_contrast(fvfm_im)
-    fm_mask = fvfm_im > fluor_thresh(fvfm_im[bg_mask == 1])
-    fm_mask = morphology.closing(fm_mask, footprint=morphology.disk(2.5))
-    fm_comp = fm_mask.astype(int) + bg_mask.astype(int)
+    fm_mask = fvfm_im > fluor_thresh(fvfm_im[bg_mask])
+    fm_mask = morphology.closing(fm_mask, footprint=DISK_2_5)
     # Combined mask
-    final_mask = np.zeros_like(comp_mask)
-    final_mask[comp_mask > 0] = 1
-    final_mask[(comp_mask == 2) & (fm_mask == 0)] = 2
+    final_mask = (comp_mask > 0).astype(np.uint8)
+    final_mask[(comp_mask == 2) & ~fm_mask] = 2
     # Save mask
-    plt.imsave(
-        fname=outdir + "/" + rgb_fn.replace(".png", "_comp.png"),
-        arr=final_mask,
-        cmap="binary_r",
-        vmin=0,
-        vmax=2
-    )
+    utils.write_mask(outdir + "/" + rgb_fn.replace(".png", "_comp.png"),
+                     final_mask)
     if diag:
         if not os.path.isdir(outdir + "/diagnostic"):
             os.mkdir(outdir + "/diagnostic")
-        plot, axes = plt.subplots(2, 2, sharex=True, sharey=True)
-        axes[0, 0].imshow(rgb_im)
-        axes[0, 1].imshow(fm_comp, cmap="viridis_r")
-        axes[1, 0].imshow(comp_mask)
-        axes[1, 1].imshow(final_mask)
-        plot.set_size_inches(20, 20)
-        plt.tight_layout()
+        fm_comp = fm_mask.astype(np.uint8) + bg_mask
+        plot, images = diagnostic_plot(final_mask.shape)
+        for image, data in zip(images,
+                               (rgb_im, fm_comp, comp_mask, final_mask)):
+            image.set_data(data)
+            image.autoscale()
         plot.savefig(outdir + "/diagnostic/" +
                      rgb_fn.replace(".png", "_mask.png"))
-    plt.close("all")
 
 
 def main():
@@ -171,8 +205,8 @@ def main():
     # Create list of files
     files = [args.rgb_path + "/" + file for file in os.listdir(args.rgb_path)]
     # Create list of parameters
-    params = zip(files, [args.fluor_path] * len(files), [args.out] * len(files),
-                 [args.d] * len(files), [args.s] * len(files))
+    params = zip(files, match_fluor(files, args.fluor_path),
+                 repeat(args.out), repeat(args.d), repeat(args.s))
     # Send to pool handler
     pool_handler(args.c, worker, params)
 
@@ -10,7 +10,7 @@ from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg,
 # Image handling
 import utils
 import segment
-from skimage import io, color, util
+from skimage import io, color
 import numpy as np
 
 
@@ -26,6 +26,7 @@ class MainWindow(tk.Tk):
         self.mask_arr = None
         self.saved_mask = None
         self.overlap_masks = False
+        self.mask_image = None
 
         # Tk variables
         self.var_th1 = tk.IntVar()
@@ -192,7 +193,7 @@ class MainWindow(tk.Tk):
         else:
             self.im_arr = io.imread(self.filename)
             if self.im_arr.shape[2] == 4:
-                self.im_arr = util.img_as_ubyte(color.rgba2rgb(self.im_arr))
+                self.im_arr = utils.rgba_to_rgb(self.im_arr)
             self.mask_arr = np.zeros(self.im_arr.shape[0:2])
             self.bt_watershed.configure(state="normal")
             self.bt_hsv.configure(state="normal")
@@ -205,6 +206,8 @@ class MainWindow(tk.Tk):
         """ Opens an image as np array """
         for child in master.winfo_children():
             child.destroy()
+        if master is self.fr_mask:
+            self.mask_image = None
         fig = plt.Figure(
             figsize=(4, 4),
             dpi=115,
@@ -212,7 +215,8 @@ class MainWindow(tk.Tk):
         )
         image = fig.add_subplot()
         if mask:
-            image.imshow(im, cmap="viridis", vmin=0, vmax=2)
+            # Kept so threshold changes only have to swap the mask data
+            self.mask_image = image.imshow(im, cmap="viridis", vmin=0, vmax=2)
         else:
             if im.ndim == 2:
                 image.imshow(im, cmap="plasma")
@@ -301,7 +305,11 @@ class MainWindow(tk.Tk):
             substep = self.mask_arr + self.saved_mask.astype(int)
             self.mask_arr[substep == 1] = 2
             self.mask_arr[substep == 2] = 1
-        self._show_image(self.mask_arr, self.fr_mask, tb=False, mask=True)
+        if self.mask_image is None:
+            self._show_image(self.mask_arr, self.fr_mask, tb=False, mask=True)
+        else:
+            self.mask_image.set_data(self.mask_arr)
+            self.mask_image.figure.canvas.draw_idle()
         self.bt_save_mask.configure(state="normal")
 
     def _to_hsv(self):
@@ -23,14 +23,18 @@ def arg_reader():
     arg_parser.add_argument("out", help="The directory to write the pixel table"
                                         "to. Does not need to be "
                                         "pre_existing.")
+    arg_parser.add_argument("-c", help="Cores used for multiprocessing, 1 by "
+                                       "default",
+                            type=int, default=1)
     return arg_parser.parse_args()
 
 
 def main():
     """ The main function """
     args = arg_reader()
-    files = [args.filename + "/" + file for file in os.listdir(args.filename)]
-    tipburn_segmentation.parse_segmentations(files, args.out)
+    with os.scandir(args.filename) as entries:
+        files = [entry.path for entry in entries if entry.is_file()]
+    tipburn_segmentation.parse_segmentations(files, args.out, args.c)
 
 
 if __name__ == "__main__":
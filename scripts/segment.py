@@ -10,6 +10,11 @@ import numpy as np
 from scipy import signal
 import utils
 
+# Merged label indexed by 2 * background + phenotype, phenotype outside the
+# foreground stays background
+MERGE_LUT = np.array([0, 0, 2, 1], dtype=np.uint8)
+DISK_2 = utils.read_only(morphology.disk(2))
+
 
 def elevation_map(rgb_im):
     """ Creates an elevation map of an RGB image based on sobel filtering
@@ -17,9 +22,7 @@ def elevation_map(rgb_im):
     :param rgb_im: numpy.ndarray, 3 dimensional array representing an RGB image
     :return: numpy.ndarray, 2 dimensional array representing an edge map
     """
-    compound_sobel = filters.sobel(rgb_im)
-    compound_sobel = compound_sobel[:, :, 0] + compound_sobel[:, :, 1] + \
-                     compound_sobel[:, :, 2]
+    compound_sobel = filters.sobel(util.img_as_float32(rgb_im)).sum(axis=2)
     elevation = filters.sobel(compound_sobel)
     return elevation
 
@@ -54,14 +57,31 @@ def multichannel_threshold(multi_ch_im, x_th=0.0, y_th=0.0, z_th=0.0,
     :return: np.nd_array, the mask created based on the thresholds, 2D array
         same width and height as the input
     """
-    mask = np.ones(multi_ch_im.shape[0:2])
-    mask[multi_ch_im[:, :, 0] < x_th] = 0
-    mask[multi_ch_im[:, :, 1] < y_th] = 0
-    mask[multi_ch_im[:, :, 2] < z_th] = 0
-    mask = mask.astype(int)
+    below = ((multi_ch_im[:, :, 0] < x_th) | (multi_ch_im[:, :, 1] < y_th) |
+             (multi_ch_im[:, :, 2] < z_th))
     if inverse:
-        mask = np.invert(mask)
-    return mask
+        return below.astype(np.uint8)
+    return np.invert(below).astype(np.uint8)
+
+
+def label_average(labels, rgb_im):
+    """ Colors each label with its average color, like label2rgb kind="avg"
+
+    :param labels: np.ndarray, 2d array of non-negative labels, 0 is background
+    :param rgb_im: np.ndarray, 3 dimensional array representing an RGB image
+    :return: np.ndarray, array with the shape and dtype of rgb_im, every pixel
+        has the average color of its label, background is black
+    """
+    flat_labels = labels.ravel()
+    counts = np.bincount(flat_labels)
+    sums = np.stack(
+        [np.bincount(flat_labels, weights=rgb_im[:, :, channel].ravel(),
+                     minlength=counts.size) for channel in range(3)],
+        axis=1
+    )
+    means = sums / np.maximum(counts, 1)[:, np.newaxis]
+    means[0] = 0
+    return means.astype(rgb_im.dtype)[labels]
 
 
 def watershed_blur(rgb_im, n_seeds):
@@ -75,8 +95,7 @@ def watershed_blur(rgb_im, n_seeds):
     elevation = elevation_map(rgb_im)
     seeds = map_grid(n_seeds, rgb_im.shape[0:2])
     labels = segmentation.watershed(elevation, seeds)
-    average_cols = color.label2rgb(labels, rgb_im, kind="avg",
-                                   bg_label=0).astype(np.uint8)
+    average_cols = label_average(labels, rgb_im).astype(np.uint8)
     return average_cols
 
 
@@ -95,8 +114,7 @@ def water_hsv_thresh(rgb_im, n_seeds, h_th=0.0, s_th=0.0, v_th=0.0):
     """
     blurred = watershed_blur(rgb_im, n_seeds)
     hsv_blurred = color.rgb2hsv(blurred)
-    mask = multichannel_threshold(hsv_blurred, h_th, s_th, v_th)
-    return mask.astype(int)
+    return multichannel_threshold(hsv_blurred, h_th, s_th, v_th)
 
 
 def sw_segmentation(image):
@@ -105,17 +123,38 @@ def sw_segmentation(image):
     :param image: np.ndarray representing a 3d image
     :return np.ndarray, 2D mask for the image
     """
-    comp_sob = filters.sobel(image)
-    comp_sob = comp_sob[:, :, 0] + comp_sob[:, :, 1] + comp_sob[:, :, 2]
+    comp_sob = filters.sobel(util.img_as_float32(image)).sum(axis=2)
     elevation = filters.sobel(comp_sob)
-    markers = np.zeros_like(comp_sob)
+    markers = np.zeros(comp_sob.shape, dtype=np.uint8)
     markers[comp_sob <= 0.025] = 1
     markers[comp_sob >= 0.175] = 2
     mask = segmentation.watershed(elevation, markers)
-    mask = morphology.erosion(mask, footprint=morphology.disk(2))
+    mask = morphology.erosion(mask, footprint=DISK_2)
     return mask
 
 
+def histogram_thresholds(comp_sob, distance=10, bg_mod=0.15, fg_mod=0.2):
+    """ Finds background and foreground thresholds from an edge map histogram
+
+    The first histogram peak is taken as background and the second as
+    foreground, the first valley after the background peak separates them.
+
+    :param comp_sob: np.ndarray, 2D edge map, as made by sobel filtering
+    :param distance: int, minimal distance between local maxima and minima
+    :param bg_mod: float, modifier for histogram segmentation
+    :param fg_mod: float, modifier for histogram segmentation
+    :return tuple, the background threshold and the foreground threshold
+    """
+    values, bins = np.histogram(comp_sob, bins=100)
+    max_i, _ = signal.find_peaks(values, distance=distance)
+    min_i, _ = signal.find_peaks(-values, distance=distance)
+    min_i = min_i[min_i > max_i[0]]
+    bg_peak, valley, fg_peak = bins[max_i[0]], bins[min_i[0]], bins[max_i[1]]
+    bg_thresh = bg_peak + (bg_mod * (valley - bg_peak))
+    fg_thresh = valley + (fg_mod * (fg_peak - valley))
+    return bg_thresh, fg_thresh
+
+
 def shw_segmentation(image, distance=10, bg_mod=0.15, fg_mod=0.2):
     """ Creates binary image through sobel + histogram thresholds + watershed
 
@@ -126,22 +165,16 @@ def shw_segmentation(image, distance=10, bg_mod=0.15, fg_mod=0.2):
     :return np.ndarray, 2D mask for the image
     """
     if image.shape[2] == 4:
-        image = util.img_as_ubyte(color.rgba2rgb(image))
-    comp_sob = filters.sobel(image)
-    comp_sob = comp_sob[:, :, 0] + comp_sob[:, :, 1] + comp_sob[:, :, 2]
+        image = utils.rgba_to_rgb(image)
+    comp_sob = filters.sobel(util.img_as_float32(image)).sum(axis=2)
     elevation = filters.sobel(comp_sob)
-    values, bins = np.histogram(comp_sob, bins=100)
-    max_i, _ = signal.find_peaks(values, distance=distance)
-    max_bins = bins[max_i]
-    min_i, _ = signal.find_peaks(-values, distance=distance)
-    min_bins = bins[min_i]
-    min_bins = min_bins[min_bins > max_bins[0]]
-    markers = np.zeros_like(comp_sob)
-    markers[comp_sob <= max_bins[0] + (bg_mod * (min_bins[0] - max_bins[0]))] = 1
-    markers[comp_sob >= min_bins[0] + (fg_mod * (max_bins[1] - min_bins[0]))] = 2
-    markers = markers.astype(int)
+    bg_thresh, fg_thresh = histogram_thresholds(comp_sob, distance, bg_mod,
+                                                fg_mod)
+    markers = np.zeros(comp_sob.shape, dtype=np.uint8)
+    markers[comp_sob <= bg_thresh] = 1
+    markers[comp_sob >= fg_thresh] = 2
     mask = segmentation.watershed(elevation, markers)
-    mask = morphology.erosion(mask, footprint=morphology.disk(2))
+    mask = morphology.erosion(mask, footprint=DISK_2)
     return mask - 1
 
 
@@ -155,12 +188,8 @@ def merge_masks(bg_mask, pheno_mask):
     :return np.ndarray, 2D mask with background marked as 0, foreground as 1 and
         phenotype area as 2
     """
-    substep = bg_mask.astype(int) + pheno_mask.astype(int)
-    comb_mask = np.zeros_like(bg_mask)
-    comb_mask[substep == 1] = 2
-    comb_mask[substep == 2] = 1
-    comb_mask[bg_mask == 0] = 0
-    return comb_mask
+    index = (bg_mask.astype(np.uint8) << 1) | pheno_mask.astype(np.uint8)
+    return MERGE_LUT[index].astype(bg_mask.dtype, copy=False)
 
 
 def barb_thresh(im_channel, div=3):
@@ -181,8 +210,9 @@ def barb_thresh(im_channel, div=3):
         bound = 0.2 * val_max
     else:
         bound = 0.5 * val_max
-    ref_val = values[values > bound][-1]
-    ref_i = np.where(values == ref_val)[0][0]
+    # First bin with the count of the last bin above the bound
+    ref_val = values[np.flatnonzero(values > bound)[-1]]
+    ref_i = np.argmax(values == ref_val)
     ref_bin = bins[ref_i]
     thresh = 2 * ref_bin / div
     return thresh
@@ -202,19 +232,19 @@ def barb_hue(image, bg_mask=None, div=3):
         # Apply mask to rgb_im
         image = utils.multichannel_mask(image, bg_mask)
     # Get hue channel and scale from 0 to 1
-    hue = color.rgb2hsv(image)[:, :, 0]
+    hue = utils.rgb_hue(image)
     hue_con = utils.increase_contrast(hue)
     hue_fg = hue_con[bg_mask == 1]
     # Healthy tissue masking
     thresh = barb_thresh(hue_fg, div)
-    healthy_mask = (hue_con > thresh).astype(int)
+    healthy_mask = hue_con > thresh
     # Remove noise
     healthy_mask = morphology.remove_small_holes(
         healthy_mask,
         area_threshold=(image.shape[0] + image.shape[1]) // 200
     )
     # Combine healthy and bg mask to get compound image
-    bg_mask = bg_mask.astype(int)
+    bg_mask = bg_mask.astype(np.uint8)
     comp_mask = merge_masks(bg_mask, healthy_mask)
     return comp_mask
 
@@ -8,12 +8,15 @@ and for splitting the foreground into healthy and unhealthy tissue.
 import os
 import segment
 import utils
-from skimage import io, util, color, morphology, segmentation
+from skimage import io, util, morphology
 from multiprocessing import Pool
-import numpy as np
 import argparse as arg
-import matplotlib.pyplot as plt
 import re
+import csv
+
+FILENAME_PATTERN = re.compile(r"([0-9]+)-([0-9]+).+Tray_0([0-9]*)"
+                              r".+pos([0-9*])_(.*).png")
+DISK_2 = utils.read_only(morphology.disk(2))
 
 
 def arg_reader():
@@ -57,7 +60,7 @@ def segment_file(arg_tup):
     try:
         rgb_im = io.imread(filename)
         if rgb_im.shape[2] == 4:
-            rgb_im = util.img_as_ubyte(color.rgba2rgb(rgb_im))
+            rgb_im = utils.rgba_to_rgb(rgb_im)
     except:
         print(f"Could not open {filename}")
     else:
@@ -66,100 +69,107 @@ def segment_file(arg_tup):
         except:
             print(f"Could not segment foreground from background in {filename}")
         else:
-            bg_mask = utils.canny_central_ob(rgb_im, bg_mask, sigma)
-            bg_mask = morphology.opening(bg_mask,
-                                         footprint=np.ones((5, 10)))
-            bg_mask = morphology.opening(bg_mask,
-                                         footprint=np.ones((10, 5)))
-            plt.imsave(
-                fname=out_fn.replace(".png", "_bg.png"),
-                arr=bg_mask,
-                cmap="binary_r"
-            )
+            try:
+                bg_mask = utils.canny_central_ob(rgb_im, bg_mask, sigma)
+            except:
+                print(f"Could not isolate primary object in {filename}")
+                return
+            bg_mask = morphology.opening(bg_mask, footprint=utils.RECT_5_10)
+            bg_mask = morphology.opening(bg_mask, footprint=utils.RECT_10_5)
+            io.imsave(out_fn.replace(".png", "_bg.png"),
+                      util.img_as_ubyte(bg_mask), check_contrast=False)
             try:
                 comp_mask = segment.barb_hue(
                     rgb_im,
-                    morphology.erosion(bg_mask.copy(),
-                                       footprint=morphology.disk(2)))
+                    morphology.erosion(bg_mask, footprint=DISK_2))
             except:
                 print(f"Could not segment healthy from brown in {filename}")
             else:
                 if diagnostic:
-                    plt.imsave(
-                        fname=out_fn.replace(".png", "_comp.png"),
-                        arr=comp_mask,
-                        cmap="binary_r",
-                        vmin=0,
-                        vmax=2
-                    )
+                    utils.write_mask(out_fn.replace(".png", "_comp.png"),
+                                     comp_mask)
                     if not os.path.isdir(outfile + "/diagnostic"):
                         os.mkdir(outfile + "/diagnostic")
-                    bg_diag = segmentation.mark_boundaries(
-                        rgb_im, bg_mask,
-                        color=(7 / 255, 234 / 255, 250 / 255))
+                    bg_diag = utils.mark_outline(rgb_im, bg_mask,
+                                                 (7, 234, 250))
                     out_fn = outfile + "/diagnostic/" + filename.split("/")[-1]
-                    plt.imsave(
-                        fname=out_fn.replace(".png", "_bg.png"),
-                        arr=bg_diag
-                    )
+                    io.imsave(out_fn.replace(".png", "_bg.png"), bg_diag)
                     fg_diag = utils.multichannel_mask(rgb_im, comp_mask == 2)
-                    fg_diag = segmentation.mark_boundaries(
-                        fg_diag, bg_mask,
-                        color=(7 / 255, 234 / 255, 250 / 255))
-                    plt.imsave(
-                        fname=out_fn.replace(".png", "_fg.png"),
-                        arr=fg_diag
-                    )
+                    fg_diag = utils.mark_outline(fg_diag, bg_mask,
+                                                 (7, 234, 250))
+                    io.imsave(out_fn.replace(".png", "_fg.png"), fg_diag)
+
+
+def parse_file(arg_tup):
+    """ Counts the healthy and brown pixels in the mask of a single image
 
+    :param arg_tup: tuple, contains all parameters in order file, out_dir
+    :return: list, the fields parsed from the filename followed by the healthy
+        and brown pixel counts of the full plant and of the hearth
+    """
+    file, out_dir = arg_tup
+    match = FILENAME_PATTERN.match(os.path.basename(file))
+    if match:
+        exp_dat = list(match.groups())
+    else:
+        exp_dat = ["NA"] * 5
+    mask_fn = out_dir + "/" + file.split("/")[-1]
+    mask_fn = mask_fn.replace(".png", "_comp.png")
+    mask = None
+    if os.path.isfile(mask_fn):
+        try:
+            mask = utils.read_mask(mask_fn)
+        except:
+            print(f"Could not read {mask_fn}")
+    if mask is None:
+        exp_dat += ["NA", "NA", "NA", "NA"]
+    else:
+        full_counts = utils.disk_counts(mask, (min(mask.shape) - 1) / 2)
+        hearth_counts = utils.disk_counts(mask, (min(mask.shape) - 2) / 4)
+        exp_dat += [full_counts[1], full_counts[2], hearth_counts[1],
+                    hearth_counts[2]]
+    return exp_dat
 
-def parse_segmentations(image_files, out_dir):
+
+def _write_rows(writer, rows, total):
+    """ Writes the parsed rows to the pixel table, printing progress
+
+    :param writer: csv.writer, the writer of the pixel table
+    :param rows: iterable, the rows to write
+    :param total: int, the total amount of rows, used for printing progress
+    :return: None, writes the rows
+    """
+    for count, exp_dat in enumerate(rows, start=1):
+        writer.writerow(exp_dat)
+        if count % 100 == 0 or count == total:
+            print(f"File {count} of {total} parsed")
+
+
+def parse_segmentations(image_files, out_dir, cores=1):
     """ Function to parse segmentation images
 
     :param image_files: str, the directory containing the RGB images matching
         the segmentation masks in out_dir
     :param out_dir: str, the directory to write the pixel table, also contains
         the segmentation masks as grayscale images
+    :param cores: int, amount of cores used to parse the masks
     :return: None, writes a tab separated file
     """
-    filename_pattern = re.compile(r".*[\/\\]([0-9]+)-([0-9]+).+Tray_0([0-9]*)"
-                                  r".+pos([0-9*])_(.*).png")
-    outfile = open(out_dir + "/pixel_table.txt", "w")
-    outfile.write("\t".join(
-        ["experiment", "round", "tray", "position", "accession", "full_healthy",
-         "full_brown", "hearth_healthy", "hearth_brown"]) + "\n"
-    )
-    count = 0
-    for file in image_files:
-        match = filename_pattern.search(file)
-        if match:
-            exp_dat = list(match.groups())
-        else:
-            exp_dat = ["NA"] * 5
-        mask_fn = out_dir + "/" + file.split("/")[-1]
-        mask_fn = mask_fn.replace(".png", "_comp.png")
-        try:
-            mask = io.imread(mask_fn, as_gray=True) // 0.5
-        except:
-            exp_dat += ["NA", "NA", "NA", "NA"]
+    with open(out_dir + "/pixel_table.txt", "w", newline="",
+              buffering=1 << 20) as outfile:
+        writer = csv.writer(outfile, delimiter="\t", lineterminator="\n")
+        writer.writerow(
+            ["experiment", "round", "tray", "position", "accession",
+             "full_healthy", "full_brown", "hearth_healthy", "hearth_brown"]
+        )
+        params = [(file, out_dir) for file in image_files]
+        if cores == 1:
+            rows = map(parse_file, params)
+            _write_rows(writer, rows, len(image_files))
         else:
-            full_mask = morphology.disk((min(mask.shape[:2]) - 1)/2) * mask
-            healthy_full = (full_mask == 1).sum()
-            brown_full = (full_mask == 2).sum()
-            hearth_disk = morphology.disk((min(mask.shape[:2]) - 2)/4)
-            hearth = utils.crop_region(
-                mask,
-                (mask.shape[0] // 2, mask.shape[1] // 2),
-                (hearth_disk.shape[0], hearth_disk.shape[1])
-            )
-            hearth_mask = hearth * hearth_disk
-            healthy_hearth = (hearth_mask == 1).sum()
-            brown_hearth = (hearth_mask == 2).sum()
-            exp_dat += [healthy_full, brown_full, healthy_hearth, brown_hearth]
-        exp_dat = [str(dat) for dat in exp_dat]
-        outfile.write("\t".join(exp_dat) + "\n")
-        count += 1
-        print(f"File {count} of {len(image_files)} parsed")
-    outfile.close()
+            with Pool(cores) as pools:
+                rows = pools.imap(parse_file, params, chunksize=32)
+                _write_rows(writer, rows, len(image_files))
 
 
 def pool_handler(cores, fun, params):
@@ -170,8 +180,14 @@ def pool_handler(cores, fun, params):
     :param params: tuple, the parameter tuples
     :return: None, maps arguments to function
     """
-    pools = Pool(cores)
-    pools.map(fun, params)
+    if cores == 1:
+        for param in params:
+            fun(param)
+        return
+    # Every file takes seconds, so they are handed out one at a time
+    with Pool(cores) as pools:
+        for _ in pools.imap_unordered(fun, params):
+            pass
 
 
 def main():
@@ -5,6 +5,8 @@ from skimage import io, color, morphology
 import matplotlib.pyplot as plt
 import utils
 
+DISK_1_5 = utils.read_only(morphology.disk(1.5))
+
 
 def arg_reader():
     """ Reads arguments from command line
@@ -83,9 +85,8 @@ def main():
                     rgb_im=image, n_seeds=args.seeds, h_th=args.hb,
                     s_th=args.sb, v_th=args.vb
                 )
-                footprint = morphology.disk(radius=1.5)
                 bg_mask = morphology.erosion(
-                    image=bg_mask, footprint=footprint
+                    image=bg_mask, footprint=DISK_1_5
                 )
                 hsv_im = color.rgb2hsv(image)
                 pheno_mask = utils.threshold_between(
@@ -5,8 +5,35 @@ Date: 11/10/2023
 
 Utility functions for image analysis
 """
+import os
+import json
 import numpy as np
-from skimage import feature, measure, morphology, color, graph, segmentation
+from skimage import feature, measure, morphology, color, graph, segmentation, \
+    io, util
+
+
+def read_only(array):
+    """ Marks an array as read-only
+
+    Used for the footprints that are shared by all calls in a module, so a
+    caller can not change them in place for everyone else.
+
+    :param array: np.ndarray, the array to protect
+    :return: np.ndarray, the same array, no longer writeable
+    """
+    array.flags.writeable = False
+    return array
+
+
+CROP_PACK = "crops.npy"
+CROP_INDEX = "crops.json"
+# Rectangles decomposed into a column and a row, which gives the same opening
+# as np.ones((5, 10)) and np.ones((10, 5)) in a fraction of the time
+RECT_5_10 = ((read_only(np.ones((5, 1))), 1),
+             (read_only(np.ones((1, 10))), 1))
+RECT_10_5 = ((read_only(np.ones((10, 1))), 1),
+             (read_only(np.ones((1, 5))), 1))
+DISK_3 = read_only(morphology.disk(3))
 
 
 def crop_region(image, centre, shape):
@@ -33,6 +60,91 @@ def crop_region(image, centre, shape):
     return crop
 
 
+def crop_region_padded(image, centre, shape):
+    """ Crops an image area around a central point, zero filling out of bounds
+
+    Equivalent to padding the image with zeros and then using crop_region, but
+    only the crop itself is allocated. Used for the fluorescence crops in
+    fluor_cropper, Exp_3_cropper crops the RGB images with PIL instead.
+
+    :param image: np.ndarray, matrix representing the image
+    :param centre: tuple, contains the x and y coordinate of the centre as
+        integers
+    :param shape: tuple, contains the height and width of the subregion in
+        pixels as integers
+    :return: The cropped region of the original image, parts falling outside of
+        the image are 0
+    """
+    row_start = centre[1] - shape[0] // 2
+    row_end = centre[1] + shape[0] // 2
+    col_start = centre[0] - shape[1] // 2
+    col_end = centre[0] + shape[1] // 2
+    crop = np.zeros(
+        (row_end - row_start, col_end - col_start) + image.shape[2:],
+        dtype=image.dtype
+    )
+    src_r0, src_r1 = max(row_start, 0), min(row_end, image.shape[0])
+    src_c0, src_c1 = max(col_start, 0), min(col_end, image.shape[1])
+    if src_r0 < src_r1 and src_c0 < src_c1:
+        crop[
+            src_r0 - row_start: src_r1 - row_start,
+            src_c0 - col_start: src_c1 - col_start
+        ] = image[src_r0:src_r1, src_c0:src_c1]
+    return crop
+
+
+_CENTRE_DISKS = {}
+
+
+def centre_disk(shape, radius):
+    """ Creates a boolean mask of a disk in the centre of an image
+
+    Disks are cached per shape and radius, the returned array is read-only.
+
+    :param shape: tuple, contains the height and width of the image in pixels
+    :param radius: float, the radius of the disk in pixels
+    :return np.ndarray, 2d boolean array of the given shape, True within the
+        disk
+    """
+    key = (tuple(shape), radius)
+    if key not in _CENTRE_DISKS:
+        rows = np.arange(shape[0]) - (shape[0] - 1) / 2
+        cols = np.arange(shape[1]) - (shape[1] - 1) / 2
+        disk = rows[:, None] ** 2 + cols[None, :] ** 2 <= radius ** 2
+        disk.flags.writeable = False
+        _CENTRE_DISKS[key] = disk
+    return _CENTRE_DISKS[key]
+
+
+_DISK_WINDOWS = {}
+
+
+def disk_counts(mask, radius, minlength=3):
+    """ Counts the labels of a mask within a disk in its centre
+
+    Only the bounding box of the disk is indexed, the box and the disk within
+    it are cached per shape and radius.
+
+    :param mask: np.ndarray, 2D array of non-negative integer labels
+    :param radius: float, the radius of the disk in pixels
+    :param minlength: int, minimal length of the returned counts
+    :return np.ndarray, the amount of pixels within the disk for each label
+    """
+    key = (mask.shape, radius)
+    if key not in _DISK_WINDOWS:
+        disk = centre_disk(mask.shape, radius)
+        rows = np.flatnonzero(disk.any(axis=1))
+        cols = np.flatnonzero(disk.any(axis=0))
+        if rows.size:
+            window = (slice(rows[0], rows[-1] + 1),
+                      slice(cols[0], cols[-1] + 1))
+        else:
+            window = (slice(0, 0), slice(0, 0))
+        _DISK_WINDOWS[key] = window, np.ascontiguousarray(disk[window])
+    window, disk = _DISK_WINDOWS[key]
+    return np.bincount(mask[window][disk], minlength=minlength)
+
+
 def read_fimg(filename):
     """ Turns an FIMG value into a normalized file with data between 0 and 1
 
@@ -46,6 +158,84 @@ def read_fimg(filename):
     return image
 
 
+def read_mask(filename):
+    """ Reads a mask image as written by the segmentation scripts into labels
+
+    The masks are saved as grayscale images where background is black, healthy
+    tissue is grey and brown tissue is white.
+
+    :param filename: str, name of the mask file that is to be opened
+    :return np.ndarray, 2D uint8 array with background as 0, healthy tissue as 1
+        and brown tissue as 2
+    """
+    mask = io.imread(filename)
+    if mask.ndim == 3:
+        mask = mask[:, :, 0]
+    return mask // 127
+
+
+def write_mask(filename, mask):
+    """ Saves a mask with labels 0, 1 and 2 as a grayscale image
+
+    :param filename: str, name of the file that is to be written
+    :param mask: np.ndarray, 2D array with background as 0, healthy tissue as 1
+        and brown tissue as 2
+    :return: None, writes the mask so it can be read back with read_mask
+    """
+    io.imsave(filename, mask.astype(np.uint8) * np.uint8(127),
+              check_contrast=False)
+
+
+_CROP_PACKS = {}
+
+
+def load_crop_pack(directory):
+    """ Opens the packed crops written by Exp_3_cropper.py with --pack
+
+    Packs are cached per directory, so every process opens them only once.
+
+    :param directory: str, the directory containing CROP_PACK and CROP_INDEX
+    :return: tuple, the memory-mapped crops and a dict with the crop filenames
+        as keys and their position in the crops as values. None if there is
+        no pack in directory.
+    """
+    if directory not in _CROP_PACKS:
+        index_fn = os.path.join(directory, CROP_INDEX)
+        if os.path.isfile(index_fn):
+            with open(index_fn) as index_file:
+                index = json.load(index_file)
+            crops = np.load(os.path.join(directory, CROP_PACK), mmap_mode="r")
+            _CROP_PACKS[directory] = crops, index
+        else:
+            _CROP_PACKS[directory] = None
+    return _CROP_PACKS[directory]
+
+
+def list_images(directory):
+    """ Lists the images in a directory, looking inside a crop pack if present
+
+    :param directory: str, the directory holding the images
+    :return: list, the filenames of the images without the directory
+    """
+    pack = load_crop_pack(directory)
+    if pack is None:
+        return os.listdir(directory)
+    return list(pack[1])
+
+
+def read_image(filename):
+    """ Reads an image from disk or from the crop pack in its directory
+
+    :param filename: str, path of the image that is to be opened
+    :return np.ndarray, the image
+    """
+    pack = load_crop_pack(os.path.dirname(filename))
+    if pack is not None and os.path.basename(filename) in pack[1]:
+        crops, index = pack
+        return np.array(crops[index[os.path.basename(filename)]])
+    return io.imread(filename)
+
+
 def threshold_between(image, x_low=None, x_high=None, y_low=None, y_high=None,
                       z_low=None, z_high=None, and_mask=True):
     """ Thresholds an image array for being between two values for each channels
@@ -104,6 +294,48 @@ def increase_contrast(im_channel):
     return out
 
 
+def rgb_hue(rgb_im):
+    """ Computes only the hue channel of an RGB image
+
+    Gives the same values as color.rgb2hsv(rgb_im)[:, :, 0], without computing
+    the saturation and value channels.
+
+    :param rgb_im: np.ndarray, 3d array representing an RGB image
+    :return np.ndarray, 2d float array with the hue, ranging from 0 to 1
+    """
+    # Same precision as rgb2hsv, so thresholds on the hue give the same result
+    rgb = util.img_as_float(rgb_im)
+    red, green, blue = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
+    max_c = rgb.max(axis=2)
+    delta = max_c - rgb.min(axis=2)
+    grey = delta == 0
+    delta[grey] = 1
+    # Red is max, overwritten by green and then blue on ties like rgb2hsv
+    hue = (green - blue) / delta
+    idx = green == max_c
+    hue[idx] = 2 + (blue[idx] - red[idx]) / delta[idx]
+    idx = blue == max_c
+    hue[idx] = 4 + (red[idx] - green[idx]) / delta[idx]
+    hue = (hue / 6) % 1
+    hue[grey] = 0
+    return hue
+
+
+def rgba_to_rgb(image):
+    """ Converts an RGBA image to an 8 bit RGB image on a white background
+
+    Fully opaque images skip the float conversion of color.rgba2rgb, which
+    gives the same result for them.
+
+    :param image: np.ndarray, 3D array representing an RGBA image
+    :return np.ndarray, 3D uint8 array representing the RGB image
+    """
+    alpha = image[:, :, 3]
+    if image.dtype == np.uint8 and alpha.min() == 255:
+        return np.ascontiguousarray(image[:, :, :3])
+    return util.img_as_ubyte(color.rgba2rgb(image))
+
+
 def multichannel_mask(image, mask):
     """ Takes an image and applies a mask to every channel
 
@@ -179,7 +411,7 @@ def canny_central_ob(image, mask, sigma, central_area=200):
         y_low=s_main - 0.25, y_high=s_main + 0.25,
         z_low=v_main - 0.25, z_high=v_main + 0.25
     )
-    mask = morphology.closing(mask, footprint=morphology.disk(3))
+    mask = morphology.closing(mask, footprint=DISK_3)
     mask = morphology.remove_small_holes(mask, area_threshold=150)
     return mask
 
@@ -223,6 +455,23 @@ def paint_col(image, mask, color_tuple):
     return image
 
 
+def mark_outline(image, mask, color_tuple=(255, 255, 0)):
+    """ Draws the outline of a mask on an image
+
+    Gives the same result as segmentation.mark_boundaries converted to uint8,
+    without creating a float copy of the image.
+
+    :param image: np.ndarray, 3d array representing an RGB image
+    :param mask: np.ndarray, 2d binary mask or labelled image
+    :param color_tuple: tuple, contains the values in integer of the R, G and B
+        channel of the outline
+    :return: np.ndarray, copy of the input image with the mask outline drawn
+    """
+    image = image.copy()
+    image[segmentation.find_boundaries(mask, mode="outer")] = color_tuple
+    return image
+
+
 def slic_central(image, mask):
     """ Uses canny filter and color channel thresholding to take central object
 